@@ -20,11 +20,20 @@ def get_params():
     parser.add_argument("--dev_id", type=int, default=0, help='cuda id')
     parser.add_argument("--bi", action="store_true", help='use biGRU')
     parser.add_argument("--use_crf", action="store_true", help='use crf')
+    parser.add_argument("--compile_crf", action="store_true", help='torch.compile the crf forward step')
+    parser.add_argument("--graph_crf", action="store_true", help='replay the crf normalizer from cuda graphs')
     parser.add_argument("--atten_flag", action="store_true", help='use attention in seq2seq')
     parser.add_argument("--tf_ratio", type=float, default=0.5, help='teacher forcing ratio')
     parser.add_argument("--drop_prob", type=float, default=0.5, help='dropout probability')
     parser.add_argument("--gamma", type=float, default=10000, help='penalty for unreachable')
     parser.add_argument("--topn", type=int, default=5, help='select topn in test mode')
+    parser.add_argument("--decode_method", type=str, default='viterbi',
+                        choices=['viterbi', 'beam', 'sparse'],
+                        help='crf decoding algorithm, sparse only scans reachable transitions')
+    parser.add_argument("--beam_size", type=int, default=5, help='beam size of beam search decoding')
+    parser.add_argument("--decode_device", type=str, default=None,
+                        help='run crf viterbi decoding on this device, e.g. cpu')
+    parser.add_argument("--amp", action="store_true", help='bfloat16 autocast in crf on cuda')
     parser.add_argument("--neg_nums", type=int, default=800, help='select negetive sampling number')
     args, _ = parser.parse_known_args()
 
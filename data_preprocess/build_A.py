@@ -1,4 +1,5 @@
 import pickle
+import numpy as np
 import torch
 """
     build adjacency matrix of road_graph
@@ -6,14 +7,15 @@ import torch
 data_path = '../data/'
 road_graph = pickle.load(open(data_path + 'road_graph.pkl', 'rb'))
 n = road_graph.number_of_nodes()
-A = torch.eye(n)
 
-adj = dict(road_graph.adj)
-for k,v in adj.items():
-    v = dict(v)
-    for i in v.keys():
-        A[k][i] = 1
-        A[i][k] = 1
+# edges in both directions and self loops, as COO indices
+rows, cols = zip(*road_graph.edges())
+rows, cols = np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+loops = np.arange(n, dtype=np.int64)
+idx = np.concatenate([np.stack([rows, cols]),
+                      np.stack([cols, rows]),
+                      np.stack([loops, loops])], axis=1)
+idx = np.unique(idx, axis=1)
+A = torch.sparse_coo_tensor(torch.from_numpy(idx), torch.ones(idx.shape[1]), (n, n)).coalesce()
 
-
-torch.save(A, data_path+'road_graph_pt/A.pt')
\ No newline at end of file
+torch.save(A, data_path+'road_graph_pt/A.pt')
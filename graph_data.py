@@ -6,7 +6,7 @@ import os.path as osp
 
 
 class GraphData():
-    def __init__(self, root_path, data_path, layer, gamma, device) -> None:
+    def __init__(self, root_path, data_path, layer, device) -> None:
         self.device = device
         # load trace graph and road graph
         if not root_path.endswith('/'):
@@ -50,16 +50,24 @@ class GraphData():
         }
         # gain A^k
         A = torch.load(road_pt_path+'A.pt')
-        # A_list [n, n]
-        self.A_list = self.get_adj_poly(A, layer, gamma)
-    
-    def get_adj_poly(self, A, layer, gamma):
-        A_ = (A + torch.eye(self.num_roads)).to(self.device)
-        ans = A_.clone()
+        if not A.is_sparse:
+            A = A.to_sparse()
+        # A_list [n, n], sparse reachability within layer hops
+        self.A_list = self.get_adj_poly(A.coalesce(), layer)
+
+    def get_adj_poly(self, A, layer):
+        loops = torch.arange(self.num_roads)
+        row = torch.cat([A.indices()[0], loops])
+        col = torch.cat([A.indices()[1], loops])
+        A_ = SparseTensor(row=row,
+                          col=col,
+                          value=torch.ones(row.numel()),
+                          sparse_sizes=(self.num_roads,
+                                        self.num_roads)).coalesce().to(self.device)
+        A_ = A_.fill_value(1.)
+        ans = A_
         for _ in range(layer-1):
-            ans = ans @ A_
-        ans[ans != 0] = 1.
-        ans[ans == 0] = -gamma
+            ans = (ans @ A_).fill_value(1.)
         return ans
 
 
@@ -1,7 +1,300 @@
 import torch
+from typing import Tuple
 import torch.nn as nn
-import numpy as np
 import torch.nn.functional as F
+from torch_scatter import scatter_max
+from model.crf_triton import HAS_TRITON, triton_logsumexp
+from model.crf_numba import HAS_NUMBA
+if HAS_NUMBA:
+    from model.crf_numba import numba_viterbi
+
+# number of previous tags reduced at once by online_logsumexp
+LSE_TILE_SIZE = 128
+# sequence lengths are padded to a multiple of this before CUDA graph capture
+GRAPH_LEN_BUCKET = 16
+
+
+def logsumexp_(x, dim):
+    """
+    torch.logsumexp that reuses x as scratch memory instead of allocating the
+    shifted and exponentiated copies, x is overwritten.
+    """
+    # the max only stabilizes the exponentials, the result does not depend on it
+    maxes = x.detach().amax(dim=dim, keepdim=True)
+    # rows of -inf would give nan in x - maxes
+    maxes.masked_fill_(torch.isinf(maxes), 0.)
+    sums = x.sub_(maxes).exp_().sum(dim=dim)
+    return sums.log().add_(maxes.squeeze(dim))
+
+
+def online_logsumexp(score, trans, emission, tile_size=LSE_TILE_SIZE):
+    """
+    logsumexp over i of score[b, i] + trans[i, j] + emission[b, j], computed with a
+    running max and a running sum of exponentials over tiles of i so that the
+    (batch_size, k, k) tensor is never materialized at once. The reduction runs in
+    float32 whatever the dtype of the inputs.
+    score: (batch_size, k)
+    trans: (k, k)
+    emission: (batch_size, k)
+    return: (batch_size, k)
+    """
+    running_max, running_sum = None, None
+    for start in range(0, score.size(1), tile_size):
+        # shape: (batch_size, tile_size, k)
+        tile = (score[:, start:start + tile_size].unsqueeze(2) + trans[start:start + tile_size]).float()
+        # the tile is a fresh tensor, reduce it in place
+        # shape: (batch_size, k)
+        tile_lse = logsumexp_(tile, dim=1)
+        tile_max = tile_lse.detach().masked_fill(torch.isinf(tile_lse), 0.)
+        if running_max is None:
+            new_max = tile_max
+            running_sum = (tile_lse - new_max).exp()
+        else:
+            new_max = torch.maximum(running_max, tile_max)
+            running_sum = running_sum * (running_max - new_max).exp() + (tile_lse - new_max).exp()
+        running_max = new_max
+    # emission does not depend on i, add it after the reduction
+    return (running_sum.log() + running_max).to(score.dtype) + emission
+
+
+def forward_logsumexp(score, trans, emission):
+    """
+    logsumexp over i of score[b, i] + trans[i, j] + emission[b, j], with the Triton
+    kernel on cuda when triton is installed and online_logsumexp otherwise.
+    """
+    if HAS_TRITON and score.is_cuda:
+        return triton_logsumexp(score, trans, emission)
+    return online_logsumexp(score, trans, emission)
+
+
+def forward_step(score, trans, emission, step_mask):
+    """
+    One step of the forward algorithm, samples whose timestep is padded keep their score.
+    score: (batch_size, k)
+    trans: (k, k)
+    emission: (batch_size, k)
+    step_mask: (batch_size,)
+    return: (batch_size, k)
+    """
+    next_score = forward_logsumexp(score, trans, emission)
+    return torch.where(step_mask.unsqueeze(1), next_score, score)
+
+
+def fused_forward_step(score, trans, emission, step_mask):
+    """
+    Same as forward_step, written as a single broadcast and logsumexp so that
+    torch.compile fuses it into one reduction kernel.
+    """
+    next_score = torch.logsumexp((score.unsqueeze(2) + trans).float(), dim=1).to(score.dtype) + emission
+    return torch.where(step_mask.unsqueeze(1), next_score, score)
+
+
+@torch.jit.script
+def sequence_score(emissions: torch.Tensor, tags: torch.Tensor, transitions: torch.Tensor,
+                   tag_ids: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """
+    TorchScript body of CRF._compute_score.
+    """
+    # padded tags (-1) are masked out below, map them to a valid index for gather
+    tags = tags.masked_fill(mask == 0, 0)
+    float_mask = mask.float()
+    # Emission score of every tag in one gather
+    # shape: (seq_length, batch_size)
+    emit_scores = emissions.gather(2, tags.unsqueeze(-1)).squeeze(-1)
+    # Transition score of every (tags[i - 1], tags[i]) pair in one gather,
+    # on the position of each tag in tag_ids
+    # shape: (seq_length - 1, batch_size)
+    sub_tags = torch.searchsorted(tag_ids, tags.contiguous())
+    trans_scores = transitions[sub_tags[:-1], sub_tags[1:]]
+    # First emission, then transition and emission scores, only added if the
+    # timestep is valid (mask == 1)
+    # shape: (batch_size,)
+    return emit_scores[0] + ((emit_scores[1:] + trans_scores) * float_mask[1:]).sum(dim=0)
+
+
+@torch.jit.script
+def viterbi_scan(emissions: torch.Tensor, trans: torch.Tensor,
+                 mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    TorchScript recursion of the Viterbi algorithm over the candidate tags.
+    emissions: (seq_length, batch_size, k), emissions of the candidate tags
+    trans: (k, k)
+    mask: (seq_length, batch_size)
+    return: score (batch_size, k) and history (seq_length - 1, batch_size, k)
+    """
+    seq_length, batch_size = mask.size(0), mask.size(1)
+    # Start transition and first emission
+    # shape: (batch_size, k)
+    score = emissions[0]
+    # history saves where the best tags candidate transitioned from; this is used
+    # when we trace back the best tag sequence. int16 takes a quarter of the memory
+    # of int64 whenever the candidate indices fit
+    # shape: (seq_length - 1, batch_size, k)
+    history_dtype = torch.int16 if emissions.size(2) <= 32767 else torch.long
+    history = torch.empty(seq_length - 1, batch_size, emissions.size(2),
+                          dtype=history_dtype, device=score.device)
+
+    # score is a tensor of size (batch_size, num_tags) where for every batch,
+    # value at column j stores the score of the best tag sequence so far that ends
+    # with tag j
+
+    # Viterbi algorithm recursive case: we compute the score of the best tag sequence
+    # for every possible next tag
+    for i in range(1, seq_length):
+        # Broadcast viterbi score for every possible next tag
+        # shape: (batch_size, k, 1)
+        broadcast_score = score.unsqueeze(2)
+
+        # Broadcast emission score for every possible current tag
+        # shape: (batch_size, 1, k)
+        broadcast_emission = emissions[i].unsqueeze(1)
+
+        # Compute the score tensor of size (batch_size, num_tags, num_tags) where
+        # for each sample, entry at row i and column j stores the score of the best
+        # tag sequence so far that ends with transitioning from tag i to tag j and emitting
+        # shape: (batch_size, k, k)
+        next_score = broadcast_score + trans + broadcast_emission
+        # Find the maximum score over all possible current tag for the whole batch at once
+        # shape: (batch_size, num_tags)
+        next_score, indices = next_score.max(dim=1)
+
+        # Set score to the next score if this timestep is valid (mask == 1)
+        # and save the index that produces the next score
+        # shape: (batch_size, num_tags)
+        score = torch.where(mask[i].unsqueeze(1), next_score, score)
+        history[i - 1] = indices.to(history_dtype)
+    return score, history
+
+
+@torch.jit.script
+def sparse_viterbi_scan(emissions: torch.Tensor, edge_trans: torch.Tensor, src: torch.Tensor,
+                        dst: torch.Tensor, mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    TorchScript recursion of the Viterbi algorithm that only scans the reachable
+    transitions (src -> dst) between candidate tags instead of all k * k pairs.
+    emissions: (seq_length, batch_size, k), emissions of the candidate tags
+    edge_trans: (num_edges,), transition score of every reachable pair
+    src, dst: (num_edges,), every candidate tag must have at least one incoming pair
+    mask: (seq_length, batch_size)
+    return: score (batch_size, k) and history (seq_length - 1, batch_size, k)
+    """
+    seq_length, batch_size = mask.size(0), mask.size(1)
+    num_cands = emissions.size(2)
+    # shape: (batch_size, k)
+    score = emissions[0]
+    # shape: (seq_length - 1, batch_size, k)
+    history_dtype = torch.int16 if num_cands <= 32767 else torch.long
+    history = torch.empty(seq_length - 1, batch_size, num_cands,
+                          dtype=history_dtype, device=score.device)
+    for i in range(1, seq_length):
+        # Score of every reachable transition
+        # shape: (batch_size, num_edges)
+        edge_score = score.index_select(1, src) + edge_trans
+        # Find the best reachable previous tag of every tag, argmax indexes the edges
+        # shape: (batch_size, k)
+        next_score, edge_idx = scatter_max(edge_score, dst, dim=1, dim_size=num_cands)
+        next_score = next_score + emissions[i]
+
+        # Set score to the next score if this timestep is valid (mask == 1)
+        # and save the previous tag that produces the next score
+        # shape: (batch_size, k)
+        score = torch.where(mask[i].unsqueeze(1), next_score, score)
+        history[i - 1] = src[edge_idx].to(history_dtype)
+    return score, history
+
+
+@torch.jit.script
+def viterbi_backtrace(score: torch.Tensor, history: torch.Tensor,
+                      seq_ends: torch.Tensor) -> torch.Tensor:
+    """
+    TorchScript trace back of the best path for the whole batch at once.
+    score: (batch_size, k)
+    history: (seq_length - 1, batch_size, k)
+    seq_ends: (batch_size,)
+    return: (seq_length, batch_size), indices into the candidate tags
+    """
+    seq_length = history.size(0) + 1
+    # shape: (seq_length, batch_size)
+    best_tags = torch.empty(seq_length, score.size(0), dtype=torch.long, device=score.device)
+    # Find the tag which maximizes the score at the last valid timestep; score is frozen
+    # once a sample ends, so this is the best tag at seq_ends for every sample
+    # shape: (batch_size,)
+    best_last_tag = score.argmax(dim=1)
+    # We trace back where the best last tag comes from, only moving to the previous tag
+    # for samples whose sequence covers the current timestep
+    for i in range(seq_length - 1, 0, -1):
+        best_tags[i] = best_last_tag
+        prev_tag = history[i - 1].gather(1, best_last_tag.unsqueeze(1)).squeeze(1).long()
+        best_last_tag = torch.where(seq_ends >= i, prev_tag, best_last_tag)
+    best_tags[0] = best_last_tag
+    return best_tags
+
+
+@torch.jit.script
+def beam_scan(emissions: torch.Tensor, trans: torch.Tensor,
+              mask: torch.Tensor, beam_size: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    TorchScript beam search over the candidate tags, only the beam_size best partial
+    sequences of each sample are extended at every timestep.
+    emissions: (seq_length, batch_size, k), emissions of the candidate tags
+    trans: (k, k)
+    mask: (seq_length, batch_size)
+    return: score (batch_size, h), tags (seq_length, batch_size, h) and
+        parents (seq_length - 1, batch_size, h) of every hypothesis, h = min(beam_size, k)
+    """
+    seq_length, batch_size = mask.size(0), mask.size(1)
+    num_cands = emissions.size(2)
+    beam = min(beam_size, num_cands)
+    # Start with the best first emissions
+    # shape: (batch_size, h)
+    score, cur_tags = emissions[0].topk(beam, dim=1)
+    # tags saves the last tag of every hypothesis, parents saves which hypothesis of the
+    # previous timestep it extends; both are used when we trace back the best sequence
+    hyp_tags = torch.empty(seq_length, batch_size, beam, dtype=torch.long, device=score.device)
+    parents = torch.empty(seq_length - 1, batch_size, beam, dtype=torch.long, device=score.device)
+    hyp_tags[0] = cur_tags
+    # padded timesteps keep every hypothesis as it is
+    # shape: (batch_size, h)
+    keep = torch.arange(beam, device=score.device).unsqueeze(0).expand(batch_size, beam)
+    for i in range(1, seq_length):
+        # Score of extending every hypothesis with every candidate tag
+        # shape: (batch_size, h, k)
+        cand_score = score.unsqueeze(2) + trans[cur_tags] + emissions[i].unsqueeze(1)
+        # Keep the best h extensions of each sample
+        # shape: (batch_size, h)
+        next_score, flat_idx = cand_score.reshape(batch_size, -1).topk(beam, dim=1)
+        parent = torch.div(flat_idx, num_cands, rounding_mode='floor')
+        next_tags = flat_idx % num_cands
+
+        # Only move on if this timestep is valid (mask == 1)
+        step_mask = mask[i].unsqueeze(1)
+        score = torch.where(step_mask, next_score, score)
+        cur_tags = torch.where(step_mask, next_tags, cur_tags)
+        parents[i - 1] = torch.where(step_mask, parent, keep)
+        hyp_tags[i] = cur_tags
+    return score, hyp_tags, parents
+
+
+@torch.jit.script
+def beam_backtrace(score: torch.Tensor, hyp_tags: torch.Tensor,
+                   parents: torch.Tensor) -> torch.Tensor:
+    """
+    TorchScript trace back of the best hypothesis for the whole batch at once.
+    score: (batch_size, h)
+    hyp_tags: (seq_length, batch_size, h)
+    parents: (seq_length - 1, batch_size, h)
+    return: (seq_length, batch_size), indices into the candidate tags
+    """
+    seq_length = hyp_tags.size(0)
+    # shape: (seq_length, batch_size)
+    best_tags = torch.empty(seq_length, score.size(0), dtype=torch.long, device=score.device)
+    # shape: (batch_size, 1)
+    best_hyp = score.argmax(dim=1).unsqueeze(1)
+    for i in range(seq_length - 1, 0, -1):
+        best_tags[i] = hyp_tags[i].gather(1, best_hyp).squeeze(1)
+        best_hyp = parents[i - 1].gather(1, best_hyp)
+    best_tags[0] = hyp_tags[0].gather(1, best_hyp).squeeze(1)
+    return best_tags
 
 
 class CRF(nn.Module):
@@ -14,20 +307,66 @@ class CRF(nn.Module):
                  emb_dim,
                  topn,
                  neg_nums,
+                 gamma=10000,
                  device='cpu',
-                 batch_first=True) -> None:
+                 batch_first=True,
+                 compile_step=False,
+                 graph_normalizer=False,
+                 decode_method='viterbi',
+                 beam_size=5,
+                 amp=False,
+                 decode_device=None) -> None:
         super().__init__()
         self.num_tags = num_tags
         self.batch_first = batch_first
         self.device = device
         self.topn = topn
         self.neg_nums = neg_nums
+        self.gamma = gamma
+        assert decode_method in ('viterbi', 'beam', 'sparse'), f'unknown decode_method {decode_method}'
+        self.decode_method = decode_method
+        self.beam_size = beam_size
+        self.amp = amp
+        self.decode_device = decode_device
         self.W = nn.Linear(emb_dim, emb_dim, bias=False)
+        self.compile_step = compile_step
+        self.graph_normalizer = graph_normalizer
+        # both need the same number of sampled tags in every batch
+        self.static_shapes = compile_step or graph_normalizer
+        # captured normalizers keyed by the shape and dtype of the padded emissions
+        self._graphed_normalizers = {}
+        self.forward_step = forward_step
+        if compile_step:
+            assert hasattr(torch, 'compile'), 'compile_step requires torch.compile (PyTorch >= 2.0)'
+            self.forward_step = torch.compile(fused_forward_step, dynamic=False, fullgraph=True)
+
+    def autocast(self, emissions):
+        """
+        bfloat16 autocast context, only enabled with amp on cuda. CUDA graph capture
+        does not support the autocast weight cache.
+        """
+        return torch.autocast('cuda', dtype=torch.bfloat16, enabled=self.amp and emissions.is_cuda,
+                              cache_enabled=not self.graph_normalizer)
 
-    def get_transitions(self, full_road_emb, A_list):
-        # (num_tags, num_tags)
-        r = self.W(full_road_emb) @ full_road_emb.T
-        energy = A_list * F.relu(r)
+    def get_reach(self, A_list, tag_ids):
+        """
+        Reachability between the candidate tags of a batch.
+        A_list: SparseTensor (num_tags, num_tags), nonzero if reachable
+        tag_ids: (k,), sorted candidate road ids
+        return: (k, k), bool
+        """
+        return A_list.index_select(0, tag_ids).index_select(1, tag_ids).to_dense() > 0
+
+    def get_transitions(self, full_road_emb, A_list, tag_ids):
+        """
+        Transition scores restricted to the candidate tags of a batch, unreachable
+        transitions are penalized by gamma.
+        tag_ids: (k,), sorted candidate road ids
+        return: (k, k)
+        """
+        road_emb = full_road_emb.index_select(0, tag_ids)
+        r = F.relu(self.W(road_emb) @ road_emb.T)
+        energy = torch.where(self.get_reach(A_list, tag_ids), r, -self.gamma * r)
         return energy
 
     def forward(self, emissions, tags, full_road_emb, A_list, mask):
@@ -39,42 +378,45 @@ class CRF(nn.Module):
         Returns: 
             The log likelihood.
         """
-        batch_size = mask.size(0)
         if self.batch_first:
             emissions = emissions.transpose(0, 1)
             tags = tags.transpose(0, 1)
             mask = mask.transpose(0, 1)
-        # get trainsition matrix
-        transitions = self.get_transitions(full_road_emb, A_list)
-        # shape: (batch_size,)
-        numerator = self._compute_score(emissions, tags, transitions, mask)
-        # sample neg_nums satus
-        seq_ends = mask.long().sum(dim=0) - 1
-        neg_tag_sets = set()
-        for i in range(batch_size):
-            neg_tag_sets |= set(tags[:seq_ends[i] + 1, i].detach().cpu().numpy().tolist())
-        assert len(neg_tag_sets) < self.neg_nums
-        remain_nums = self.neg_nums - len(neg_tag_sets)
-        # sample from topk
-        if remain_nums > 0:
+        with self.autocast(emissions):
+            # sample neg_nums satus on device, starting from the ground truth tags
+            gold_tags = tags[mask].unique()
+            assert gold_tags.numel() < self.neg_nums
+            remain_nums = self.neg_nums - gold_tags.numel()
+            # sample from topk
             _, indices = torch.topk(emissions, dim=-1, k=3)
-            tag_sets = indices.flatten().unique().detach().cpu().numpy().tolist()
-            cand_set = [i for i in tag_sets if i not in neg_tag_sets]
-            cand_num = len(cand_set)
-            neg_tag_sets |= set(np.random.choice(cand_set, min(remain_nums, cand_num), replace=False).tolist())
-        neg_tag_sets = sorted(list(neg_tag_sets))
-        trans = transitions[neg_tag_sets, :]
-        trans = trans[:, neg_tag_sets]
-        # shape: (batch_size,)
-        denominator = self._compute_normalizer(emissions, trans, neg_tag_sets, mask)
-        # shape: (batch_size,)
-        llh = numerator - denominator
+            cand_tags = indices.flatten().unique()
+            cand_tags = cand_tags[~torch.isin(cand_tags, gold_tags)]
+            cand_tags = cand_tags[torch.randperm(cand_tags.numel(), device=cand_tags.device)[:remain_nums]]
+            tag_ids = torch.cat((gold_tags, cand_tags))
+            if self.static_shapes and tag_ids.numel() < self.neg_nums:
+                # top up with uniformly drawn tags so that the compiled step and the graphs
+                # always see neg_nums tags and are not rebuilt for every new shape
+                extra_tags = torch.randperm(self.num_tags, device=tag_ids.device)
+                extra_tags = extra_tags[~torch.isin(extra_tags, tag_ids)][:self.neg_nums - tag_ids.numel()]
+                tag_ids = torch.cat((tag_ids, extra_tags))
+            # shape: (k,), sorted
+            tag_ids, _ = tag_ids.sort()
+            # get trainsition matrix once, the sampled tags contain every ground truth tag
+            # so it serves both the numerator and the denominator
+            # shape: (k, k)
+            trans = self.get_transitions(full_road_emb, A_list, tag_ids)
+            # shape: (batch_size,)
+            numerator = self._compute_score(emissions, tags, trans, tag_ids, mask)
+            # shape: (batch_size,)
+            denominator = self._compute_normalizer(emissions, trans, tag_ids, mask)
+            # shape: (batch_size,)
+            llh = numerator - denominator
 
         return llh.sum() / mask.float().sum()
 
     def decode(self, emissions, full_road_emb, A_list, mask):
         """
-        Find the most likely tag sequence using Viterbi algorithm.
+        Find the most likely tag sequence using Viterbi algorithm or beam search.
         emissions: (batch_size, seq_length, num_tags)
         mask: (batch_size, seq_length)
         Returns:
@@ -83,156 +425,220 @@ class CRF(nn.Module):
         if self.batch_first:
             emissions = emissions.transpose(0, 1)
             mask = mask.transpose(0, 1)
-        transitions = self.get_transitions(full_road_emb, A_list)
-        return self._viterbi_decode(emissions, transitions, mask)
+        with self.autocast(emissions):
+            # gain topk
+            _, indices = torch.topk(emissions, dim=-1, k=self.topn)
+            # shape: (k,), sorted
+            tag_ids = indices.flatten().unique()
+            # gain sub transition prob matrix
+            trans = self.get_transitions(full_road_emb, A_list, tag_ids)
+            # gather the emissions of the candidate tags once
+            # shape: (seq_length, batch_size, k)
+            emissions = emissions.index_select(2, tag_ids)
+            if self.decode_method == 'beam':
+                return self._beam_decode(emissions, trans, tag_ids, mask)
+            if self.decode_method == 'sparse':
+                reach = self.get_reach(A_list, tag_ids)
+                return self._sparse_viterbi_decode(emissions, trans, reach, tag_ids, mask)
+            return self._viterbi_decode(emissions, trans, tag_ids, mask)
 
-    def _compute_score(self, emissions, tags, transitions, mask):
+    def _compute_score(self, emissions, tags, transitions, tag_ids, mask):
         """
         S(X,y)
         emissions: (seq_length, batch_size, num_tags)
         tags: (seq_length, batch_size)
         mask: (seq_length, batch_size)
-        transitions: (num_tags, num_tags)
+        transitions: (k, k), k = |tag_ids|
+        tag_ids: (k,), sorted, containing every valid tag
         return: (batch_size, )
         """
+        return sequence_score(emissions, tags, transitions, tag_ids, mask)
 
-        seq_length, batch_size = tags.shape
-        mask = mask.float()
-        # Start transition score and first emission
-        # shape: (batch_size,)
-        score = torch.zeros(batch_size).to(self.device)
-        score += emissions[0, torch.arange(batch_size), tags[0]]
-
-        for i in range(1, seq_length):
-            # Transition score to next tag, only added if next timestep is valid (mask == 1)
-            # shape: (batch_size,)
-            score += transitions[tags[i - 1], tags[i]] * mask[i]
-
-            # Emission score for next tag, only added if next timestep is valid (mask == 1)
-            # shape: (batch_size,)
-            score += emissions[i, torch.arange(batch_size), tags[i]] * mask[i]
-
-        return score
-
-    def _compute_normalizer(self, emissions, trans, neg_tag_sets, mask):
+    def _compute_normalizer(self, emissions, trans, tag_ids, mask):
         """
         emissions: (seq_length, batch_size, num_tags)
         mask: (seq_length, batch_size)
-        trans: (k, k), k = |neg_tag_sets|
+        trans: (k, k), k = |tag_ids|
+        tag_ids: (k,), sorted sampled tags
         """
+        if self.static_shapes:
+            # the compiled step and the captured graphs are specialized on static shapes
+            return self._masked_normalizer(emissions, trans, tag_ids, mask)
         seq_length = emissions.size(0)
+        # Sort samples by length so that the samples still running at any timestep
+        # are a prefix of the batch, padded timesteps are then never computed
+        # shape: (batch_size,)
+        lengths, order = mask.long().sum(dim=0).sort(descending=True)
+        steps = torch.arange(seq_length, device=lengths.device).unsqueeze(1)
+        # number of running samples at every timestep
+        batch_sizes = (lengths.unsqueeze(0) > steps).sum(dim=1).tolist()
+        # Gather the emissions of the sampled tags in the sorted order once, in the
+        # dtype of the transitions (bfloat16 under amp)
+        # shape: (seq_length, batch_size, num_tags)
+        emissions = emissions.index_select(2, tag_ids).index_select(1, order).to(trans.dtype).contiguous()
         # Start transition score and first emission; score has size of
         # (batch_size, num_tags) where for each batch, the j-th column stores
         # the score that the first timestep has tag j
         # shape: (batch_size, num_tags)
-        score = emissions[0, :, neg_tag_sets]
+        score = emissions[0]
+        # final scores in the sorted order, the rows of a sample are written when it ends
+        # shape: (batch_size, num_tags)
+        final_score = torch.empty_like(score)
         for i in range(1, seq_length):
-            # Broadcast score for every possible next tag
-            # shape: (batch_size, num_tags, 1)
-            broadcast_score = score.unsqueeze(2)
-
-            # Broadcast emission score for every possible current tag
-            # shape: (batch_size, 1, num_tags)
-            broadcast_emissions = emissions[i, :, neg_tag_sets].unsqueeze(1)
-
-            # Compute the score tensor of size (batch_size, num_tags, num_tags) where
-            # for each sample, entry at row i and column j stores the sum of scores of all
-            # possible tag sequences so far that end with transitioning from tag i to tag j
-            # and emitting
-            # shape: (batch_size, num_tags, num_tags)
-            next_score = broadcast_score + trans + broadcast_emissions
-            # Sum over all possible current tags, but we're in score space, so a sum
-            # becomes a log-sum-exp: for each sample, entry i stores the sum of scores of
-            # all possible tag sequences so far, that end in tag i
-            # shape: (batch_size, num_tags)
-            next_score = torch.logsumexp(next_score, dim=1)
+            cur_size = batch_sizes[i]
+            if cur_size < score.size(0):
+                final_score[cur_size:score.size(0)] = score[cur_size:]
+                score = score[:cur_size]
+            # Emission score of the running samples for every possible current tag
+            # shape: (cur_size, num_tags)
+            emission = emissions[i, :cur_size]
 
-            # Set score to the next score if this timestep is valid (mask == 1)
-            # shape: (batch_size, num_tags)
-            score = torch.where(mask[i].unsqueeze(1), next_score, score)
-        # # Sum (log-sum-exp) over all possible tags
+            # Sum over all possible previous tags, but we're in score space, so a sum
+            # becomes a log-sum-exp: for each sample, entry j stores the sum of scores of
+            # all possible tag sequences so far, that end in tag j
+            # shape: (cur_size, num_tags)
+            score = forward_logsumexp(score, trans, emission)
+        final_score[:score.size(0)] = score
+        # # Sum (log-sum-exp) over all possible tags, in the original order
         # shape: (batch_size,)
-        return torch.logsumexp(score, dim=1)
+        return torch.logsumexp(final_score.float(), dim=1).index_select(0, order.argsort())
 
-    def _viterbi_decode(self, emissions, transitions, mask):
+    def _masked_normalizer(self, emissions, trans, tag_ids, mask):
         """
-        emissions: (seq_length, batch_size, num_tags)
-        mask: (seq_length, batch_size)
-        transitions: (num_tags, num_tags)
+        _compute_normalizer over the full padded batch, padded timesteps are gated by mask.
         """
+        # shape: (seq_length, batch_size, num_tags)
+        emissions = emissions.index_select(2, tag_ids).to(trans.dtype).contiguous()
+        if self.graph_normalizer and emissions.is_cuda:
+            return self._graphed_normalizer(emissions, trans, mask)
+        return self._masked_forward(emissions, trans, mask)
 
-        seq_length, batch_size = mask.shape
+    def _graphed_normalizer(self, emissions, trans, mask):
+        """
+        _masked_forward replayed from a CUDA graph, so that the launches of all timesteps
+        are submitted at once. A graph is captured, forward and backward, for every new
+        bucketed sequence length and batch size.
+        emissions: (seq_length, batch_size, k), emissions of the sampled tags
+        """
+        seq_length, batch_size, _ = emissions.shape
+        # padded timesteps are masked out, the score is unchanged
+        pad_length = -seq_length % GRAPH_LEN_BUCKET
+        if pad_length > 0:
+            emissions = torch.cat((emissions, emissions.new_zeros(pad_length, *emissions.shape[1:])))
+            mask = torch.cat((mask, mask.new_zeros(pad_length, batch_size)))
+        key = (tuple(emissions.shape), emissions.dtype)
+        if key not in self._graphed_normalizers:
+            # capture on copies, the graph keeps its own static inputs
+            sample_args = tuple(t.detach().clone().requires_grad_(t.requires_grad)
+                                for t in (emissions, trans, mask))
+            self._graphed_normalizers[key] = torch.cuda.make_graphed_callables(
+                self._masked_forward, sample_args)
+        return self._graphed_normalizers[key](emissions, trans, mask)
 
-        # gain topk
-        _, indices = torch.topk(emissions, dim=-1, k=self.topn)
-        tag_sets = indices.flatten().unique().detach().cpu().numpy().tolist()
-        tag_sets = sorted(tag_sets)
-        tag_map = {i: tag for i, tag in enumerate(tag_sets)}
-        # gain sub transition prob matrix
-        trans = transitions[tag_sets, :]
-        trans = trans[:, tag_sets]
-        # Start transition and first emission
-        # shape: (batch_size, k)
-        score = emissions[0, :, tag_sets]
-        history = []
-
-        # score is a tensor of size (batch_size, num_tags) where for every batch,
-        # value at column j stores the score of the best tag sequence so far that ends
-        # with tag j
-        # history saves where the best tags candidate transitioned from; this is used
-        # when we trace back the best tag sequence
-
-        # Viterbi algorithm recursive case: we compute the score of the best tag sequence
-        # for every possible next tag
-        # next_score = torch.zeros(batch_size, self.num_tags).to(self.device)
-        # indices = torch.zeros(batch_size, self.num_tags).int()
+    def _masked_forward(self, emissions, trans, mask):
+        """
+        Forward algorithm over the emissions of the sampled tags.
+        emissions: (seq_length, batch_size, k)
+        trans: (k, k)
+        mask: (seq_length, batch_size)
+        return: (batch_size,)
+        """
+        seq_length = emissions.size(0)
+        # shape: (batch_size, num_tags)
+        score = emissions[0]
         for i in range(1, seq_length):
-            # Broadcast viterbi score for every possible next tag
-            # shape: (batch_size, k, 1)
-            broadcast_score = score.unsqueeze(2)
-
-            # Broadcast emission score for every possible current tag
-            # shape: (batch_size, 1, k)
-            broadcast_emission = emissions[i, :, tag_sets].unsqueeze(1)
-
-            # Compute the score tensor of size (batch_size, num_tags, num_tags) where
-            # for each sample, entry at row i and column j stores the score of the best
-            # tag sequence so far that ends with transitioning from tag i to tag j and emitting
-            # shape: (batch_size, k, k)
-            next_score = broadcast_score + trans + broadcast_emission
-            # for j in range(batch_size):
-            #     cur_score, cur_indices = torch.max(score[j].unsqueeze(1) + trans + emissions[i,j,:].unsqueeze(0), dim=0)
-            #     next_score[j] = cur_score
-            #     indices[j] = cur_indices.detach().cpu()
-            # Find the maximum score over all possible current tag
+            # Emission score for every possible current tag
             # shape: (batch_size, num_tags)
-            next_score, indices = next_score.max(dim=1)
-            # print(next_score.shape)
+            emission = emissions[i]
 
             # Set score to the next score if this timestep is valid (mask == 1)
-            # and save the index that produces the next score
             # shape: (batch_size, num_tags)
-            score = torch.where(mask[i].unsqueeze(1), next_score, score)
-            history.append(indices)
+            score = self.forward_step(score, trans, emission, mask[i])
+        # shape: (batch_size,)
+        return torch.logsumexp(score.float(), dim=1)
+
+    def _viterbi_decode(self, emissions, trans, tag_ids, mask):
+        """
+        emissions: (seq_length, batch_size, k), emissions of the candidate tags
+        mask: (seq_length, batch_size)
+        trans: (k, k), k = |tag_ids|
+        tag_ids: (k,), sorted
+        """
+        if self.decode_device is not None:
+            return self._device_viterbi_decode(emissions, trans, tag_ids, mask)
+        score, history = viterbi_scan(emissions, trans, mask)
+        # shape: (batch_size,)
+        seq_ends = mask.long().sum(dim=0) - 1
+        # shape: (seq_length, batch_size)
+        best_tags = viterbi_backtrace(score, history, seq_ends)
+        return self._to_tag_lists(best_tags, tag_ids, seq_ends)
+
+    def _device_viterbi_decode(self, emissions, trans, tag_ids, mask):
+        """
+        Viterbi decoding on decode_device, the inputs are transferred once. On cpu the
+        samples are decoded in parallel by numba when it is installed.
+        emissions: (seq_length, batch_size, k), emissions of the candidate tags
+        mask: (seq_length, batch_size)
+        trans: (k, k), k = |tag_ids|
+        tag_ids: (k,), sorted
+        """
+        emissions, trans, tag_ids, mask = [x.detach().to(self.decode_device)
+                                           for x in (emissions, trans, tag_ids, mask)]
+        # shape: (batch_size,)
+        seq_ends = mask.long().sum(dim=0) - 1
+        if not (HAS_NUMBA and emissions.device.type == 'cpu'):
+            score, history = viterbi_scan(emissions, trans, mask)
+            best_tags = viterbi_backtrace(score, history, seq_ends)
+            return self._to_tag_lists(best_tags, tag_ids, seq_ends)
+        # shape: (batch_size, seq_length)
+        best_tags = numba_viterbi(emissions.float().transpose(0, 1).contiguous().numpy(),
+                                  trans.float().T.contiguous().numpy(),
+                                  (seq_ends + 1).numpy())
+        best_tags = torch.from_numpy(best_tags)
+        # map sub indices back to road ids, padding stays -1
+        return torch.where(best_tags >= 0, tag_ids[best_tags.clamp(min=0)], best_tags).tolist()
 
-        # Now, compute the best path for each sample
+    def _sparse_viterbi_decode(self, emissions, trans, reach, tag_ids, mask):
+        """
+        Viterbi decoding restricted to the reachable transitions of A_list.
+        emissions: (seq_length, batch_size, k), emissions of the candidate tags
+        mask: (seq_length, batch_size)
+        trans: (k, k), k = |tag_ids|
+        reach: (k, k), bool, reachable transitions including self loops
+        tag_ids: (k,), sorted
+        """
+        # COO form of the reachable transitions
+        # shape: (num_edges,)
+        src, dst = reach.nonzero(as_tuple=True)
+        score, history = sparse_viterbi_scan(emissions, trans[src, dst], src, dst, mask)
         # shape: (batch_size,)
         seq_ends = mask.long().sum(dim=0) - 1
-        best_tags_list = []
-        for idx in range(batch_size):
-            # Find the tag which maximizes the score at the last timestep; this is our best tag
-            # for the last timestep
-            _, best_last_tag = score[idx].max(dim=0)
-            best_tags = [best_last_tag.item()]
-            # We trace back where the best last tag comes from, append that to our best tag
-            # sequence, and trace it back again, and so on
-            for hist in reversed(history[:seq_ends[idx]]):
-                best_last_tag = hist[idx][best_tags[-1]]
-                best_tags.append(best_last_tag.item())
-
-            # Reverse the order because we start from the last timestep
-            best_tags.reverse()
-            best_tags = [tag_map[t] for t in best_tags]
-            tags_len = len(best_tags)
-            best_tags_list.append(best_tags + [-1] * (seq_length - tags_len))
-        return best_tags_list
+        # shape: (seq_length, batch_size)
+        best_tags = viterbi_backtrace(score, history, seq_ends)
+        return self._to_tag_lists(best_tags, tag_ids, seq_ends)
+
+    def _beam_decode(self, emissions, trans, tag_ids, mask):
+        """
+        emissions: (seq_length, batch_size, k), emissions of the candidate tags
+        mask: (seq_length, batch_size)
+        trans: (k, k), k = |tag_ids|
+        tag_ids: (k,), sorted
+        """
+        score, hyp_tags, parents = beam_scan(emissions, trans, mask, self.beam_size)
+        # shape: (batch_size,)
+        seq_ends = mask.long().sum(dim=0) - 1
+        # shape: (seq_length, batch_size)
+        best_tags = beam_backtrace(score, hyp_tags, parents)
+        return self._to_tag_lists(best_tags, tag_ids, seq_ends)
+
+    def _to_tag_lists(self, best_tags, tag_ids, seq_ends):
+        """
+        Map candidate indices back to road ids and pad invalid timesteps with -1.
+        best_tags: (seq_length, batch_size)
+        seq_ends: (batch_size,)
+        return: list of list with length seq_length for each sample
+        """
+        best_tags = tag_ids[best_tags]
+        steps = torch.arange(best_tags.size(0), device=best_tags.device).unsqueeze(1)
+        best_tags = torch.where(steps <= seq_ends.unsqueeze(0), best_tags, torch.full_like(best_tags, -1))
+        return best_tags.transpose(0, 1).tolist()
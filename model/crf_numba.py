@@ -0,0 +1,46 @@
+import numpy as np
+
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+if HAS_NUMBA:
+    @numba.njit(parallel=True, cache=True)
+    def numba_viterbi(emissions, trans_t, seq_lens):
+        """
+        Viterbi decoding on cpu, samples are decoded in parallel.
+        emissions: (batch_size, seq_length, k), emissions of the candidate tags
+        trans_t: (k, k), transposed transitions, trans_t[j, i] is the score of i -> j
+        seq_lens: (batch_size,)
+        return: (batch_size, seq_length), index of the best candidate tag, -1 for padding
+        """
+        batch_size, seq_length, num_cands = emissions.shape
+        best_tags = np.full((batch_size, seq_length), -1, dtype=np.int64)
+        for b in numba.prange(batch_size):
+            length = seq_lens[b]
+            score = emissions[b, 0].copy()
+            next_score = np.empty_like(score)
+            history = np.empty((max(length - 1, 0), num_cands), dtype=np.int64)
+            for t in range(1, length):
+                for j in range(num_cands):
+                    # best previous tag of tag j
+                    best_i = 0
+                    best = score[0] + trans_t[j, 0]
+                    for i in range(1, num_cands):
+                        cand = score[i] + trans_t[j, i]
+                        if cand > best:
+                            best = cand
+                            best_i = i
+                    next_score[j] = best + emissions[b, t, j]
+                    history[t - 1, j] = best_i
+                score[:] = next_score
+            # trace back from the best last tag
+            best_tag = np.argmax(score)
+            best_tags[b, length - 1] = best_tag
+            for t in range(length - 1, 0, -1):
+                best_tag = history[t - 1, best_tag]
+                best_tags[b, t - 1] = best_tag
+        return best_tags
@@ -0,0 +1,83 @@
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+    HAS_TRITON = True
+except ImportError:
+    HAS_TRITON = False
+
+# tile of previous tags (i) x current tags (j) handled at once by a program
+BLOCK_I = 32
+BLOCK_J = 64
+
+
+if HAS_TRITON:
+    @triton.jit
+    def forward_step_kernel(score_ptr, trans_ptr, out_ptr, K,
+                            BLOCK_I: tl.constexpr, BLOCK_J: tl.constexpr):
+        """
+        out[b, j] = logsumexp over i of score[b, i] + trans[i, j], one program per
+        (b, block of j), reducing i tile by tile with a running max and sum.
+        """
+        b = tl.program_id(0)
+        offs_j = tl.program_id(1) * BLOCK_J + tl.arange(0, BLOCK_J)
+        mask_j = offs_j < K
+        running_max = tl.full((BLOCK_J,), float('-inf'), tl.float32)
+        running_sum = tl.zeros((BLOCK_J,), tl.float32)
+        for start in range(0, K, BLOCK_I):
+            offs_i = start + tl.arange(0, BLOCK_I)
+            mask_i = offs_i < K
+            score = tl.load(score_ptr + b * K + offs_i, mask=mask_i, other=float('-inf')).to(tl.float32)
+            trans = tl.load(trans_ptr + offs_i[:, None] * K + offs_j[None, :],
+                            mask=mask_i[:, None] & mask_j[None, :],
+                            other=float('-inf')).to(tl.float32)
+            # shape: (BLOCK_I, BLOCK_J)
+            x = score[:, None] + trans
+            new_max = tl.maximum(running_max, tl.max(x, axis=0))
+            # columns that only saw -inf so far would give nan in x - max
+            safe_max = tl.where(new_max == float('-inf'), 0., new_max)
+            running_sum = running_sum * tl.exp(running_max - safe_max) \
+                + tl.sum(tl.exp(x - safe_max[None, :]), axis=0)
+            running_max = new_max
+        out = tl.log(running_sum) + tl.where(running_max == float('-inf'), 0., running_max)
+        tl.store(out_ptr + b * K + offs_j, out, mask=mask_j)
+
+
+class TritonForwardStep(torch.autograd.Function):
+    """
+    logsumexp over i of score[b, i] + trans[i, j] without materializing the
+    (batch_size, k, k) tensor in the forward pass.
+    """
+
+    @staticmethod
+    def forward(ctx, score, trans):
+        score, trans = score.contiguous(), trans.contiguous()
+        batch_size, num_tags = score.shape
+        out = torch.empty(batch_size, num_tags, dtype=torch.float32, device=score.device)
+        grid = (batch_size, triton.cdiv(num_tags, BLOCK_J))
+        forward_step_kernel[grid](score, trans, out, num_tags, BLOCK_I=BLOCK_I, BLOCK_J=BLOCK_J)
+        ctx.save_for_backward(score, trans, out)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        score, trans, out = ctx.saved_tensors
+        # softmax over i of score[b, i] + trans[i, j], weighted by the incoming gradient
+        # shape: (batch_size, k, k)
+        weighted = (score.float().unsqueeze(2) + trans.float() - out.unsqueeze(1)).exp_()
+        weighted.mul_(grad_out.unsqueeze(1))
+        grad_score = weighted.sum(dim=2).to(score.dtype)
+        grad_trans = weighted.sum(dim=0).to(trans.dtype)
+        return grad_score, grad_trans
+
+
+def triton_logsumexp(score, trans, emission):
+    """
+    Triton version of crf.online_logsumexp, only for cuda tensors.
+    score: (batch_size, k)
+    trans: (k, k)
+    emission: (batch_size, k)
+    return: (batch_size, k)
+    """
+    return TritonForwardStep.apply(score, trans).to(score.dtype) + emission
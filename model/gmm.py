@@ -14,10 +14,17 @@ class GMM(nn.Module):
                  target_size,
                  topn,
                  neg_nums,
+                 gamma=10000,
                  atten_flag=True,
                  drop_prob=0.5,
                  bi=True,
                  use_crf=True,
+                 compile_crf=False,
+                 graph_crf=False,
+                 decode_method='viterbi',
+                 beam_size=5,
+                 amp=False,
+                 decode_device=None,
                  device="cpu") -> None:
         super().__init__()
         self.device = device
@@ -40,7 +47,14 @@ class GMM(nn.Module):
                            emb_dim=emb_dim,
                            topn=topn,
                            neg_nums=neg_nums,
-                           device=device)
+                           gamma=gamma,
+                           device=device,
+                           compile_step=compile_crf,
+                           graph_normalizer=graph_crf,
+                           decode_method=decode_method,
+                           beam_size=beam_size,
+                           amp=amp,
+                           decode_device=decode_device)
 
     def forward(self, grid_traces, tgt_roads, traces_gps, traces_lens,
                 road_lens, gdata, sample_Idx, tf_ratio):
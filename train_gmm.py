@@ -99,15 +99,21 @@ def main(args):
     gdata = GraphData(root_path=root_path,
                       data_path=data_path,
                       layer=args['layer'],
-                      gamma=args['gamma'],
                       device=device)
     print('get graph extra data finished!')
     model = GMM(emb_dim=args['emb_dim'],
                 target_size=gdata.num_roads,
                 topn=args['topn'],
                 neg_nums=args['neg_nums'],
+                gamma=args['gamma'],
                 device=device,
                 use_crf=args['use_crf'],
+                compile_crf=args['compile_crf'],
+                graph_crf=args['graph_crf'],
+                decode_method=args['decode_method'],
+                beam_size=args['beam_size'],
+                amp=args['amp'],
+                decode_device=args['decode_device'],
                 bi=args['bi'],
                 atten_flag=args['atten_flag'],
                 drop_prob=args['drop_prob'])